@@ -4,10 +4,15 @@
 import csv
 import os
 import re
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
+from itertools import islice
 from pathlib import Path
-from typing import MutableMapping, Dict, List, NewType, Any, Union
+from typing import MutableMapping, Dict, List, NewType, Any, Union, Iterable, Iterator, Optional, Tuple
 
-import botocore
+import botocore.client
+import botocore.exceptions
 from tqdm import tqdm
 
 from tools import *
@@ -16,6 +21,7 @@ __author__ = 'Samuel Lipping -- Tampere University'
 __docformat__ = 'reStructuredText'
 __all__ = ['Task', 'layout_params_from_file',
            'list_all_qualification_types',
+           'find_qualification_type_id',
            'create_custom_qualifications',
            'list_qualifications_for_hit']
 
@@ -24,6 +30,15 @@ MTurkClient = NewType('MTurkClient', botocore.client.BaseClient)
 DataDict = NewType('DataDict', MutableMapping[str, Any])
 ResultDict = NewType('ResultDict', MutableMapping[str, List[str]])
 
+# Layout parameter placeholders, e.g. ${audioUrl}
+_PLACEHOLDER_RE = re.compile(r'\$\{([a-zA-Z_0-9]+)\}')
+# Marks the place of the HIT layout in a question template
+_HIT_LAYOUT_SLOT = '__HIT_LAYOUT__'
+# Free text layout parameters, which have to be cleaned since AMT requires ASCII-only
+_CLEAN_FIELDS = frozenset(('DescriptionText', 'EditedCaption', 'captions'))
+# Number of input rows submitted for publishing at a time
+_CHUNK_SIZE = 64
+
 
 class Task:
 
@@ -32,29 +47,36 @@ class Task:
         task_config = config['TASKS'][
             config['CURRENT']['task']
         ]
+        self.task_config = task_config
+
+        # If task has specific defined requirements, use those instead of global ones.
+        # The global ones are only needed if the HITs are published with qualifications.
+        if 'REQUIREMENTS' in task_config:
+            self.requirements = task_config['REQUIREMENTS']
+        else:
+            self.requirements = config.get('REQUIREMENTS')
+        self.use_sandbox = config['USE_SANDBOX']
+        self.batch = batch = config['CURRENT']['batch']
 
         if 'collapse_instructions_token' in task_config:
             self.collapse_token = task_config['collapse_instructions_token']
         else:
             self.collapse_token = None
 
-        self.title = task_config['Title']
-        self.title += f'(Batch {config["CURRENT"]["batch"]})'
-
+        self.title = f'{task_config["Title"]}(Batch {batch})'
         self.desc = task_config['Description']
         self.keywords = task_config['Keywords']
-        self.layout = task_config['SBX_LAYOUT_ID'] if config['USE_SANDBOX'] else task_config['PROD_LAYOUT_ID']
         self.reward = task_config['Reward']
         self.max_assigns = task_config['MaxAssignments']
-        self.ut_id = config['UNIQUE_IDS'][
-            config['CURRENT']['batch'] - 1
-        ]
+        # Batches are numbered from 1
+        self.ut_id = config['UNIQUE_IDS'][batch - 1]
 
 
 def layout_params_from_file(ifile: str,
                             delim: str = ',',
                             constants: MutableMapping[str, str] = {},
-                            ignore: set = set()) \
+                            ignore: set = set(),
+                            encoding: str = 'utf-8') \
         -> List[Dict[str, str]]:
     """ Create generator for layout parameters read from csv file
 
@@ -66,6 +88,8 @@ def layout_params_from_file(ifile: str,
     :type constants: dict[str, str]
     :param ignore: Fields to ignore
     :type ignore: set[str]
+    :param encoding: Input file encoding
+    :type encoding: str
     :return: Layout parameters, format for one HIT (row):
     {
         'Name': <layout_param_name>,
@@ -73,30 +97,37 @@ def layout_params_from_file(ifile: str,
     }
     :rtype: list[dict[str, str]]
     """
-    with open(ifile, "r") as f:
-        reader = csv.reader(f, delimiter=delim, quotechar='"')
-        titles = next(reader)
+    with open(ifile, "r", newline='', buffering=1 << 20, encoding=encoding) as f:
+        reader = csv.DictReader(f, delimiter=delim, quotechar='"')
 
         # Sometimes an additional row of Column 1, 2.. is added automatically when editing csv
-        if any(t.startswith('Column') for t in titles):
-            titles = next(reader)
+        if any(t.startswith('Column') for t in reader.fieldnames):
+            reader.fieldnames = next(reader.reader)
+
+        fields = [k for k in reader.fieldnames if k != 'file_name' and k not in ignore]
 
         for row in reader:
-            values = row
-            layout_params = []
-            param_dict = {}
-            for k, v in constants.items():
-                param_dict[k] = v
+            # Missing values (None) of short rows are left out
+            param_dict = {**constants, **{k: row[k] for k in fields if row[k] is not None}}
+            layout_params = [{'Name': k, 'Value': v} for k, v in param_dict.items()]
 
-            for i, value in enumerate(values):
-                field_name = titles[i]
-                if field_name != 'file_name' and field_name not in ignore:
-                    param_dict[field_name] = value
+            yield layout_params, param_dict
 
-            for k, v in param_dict.items():
-                layout_params.append({'Name': k, 'Value': v})
 
-            yield layout_params, param_dict
+def chunks(iterable: Iterable[Any],
+           n: int) \
+        -> Iterator[List[Any]]:
+    """ Split an iterable into lists of n items (the last one may be shorter)
+
+    :param iterable: Items to split
+    :type iterable: iterable
+    :param n: Number of items per list
+    :type n: int
+    :return: Generator of lists of items
+    :rtype: iterator[list]
+    """
+    it = iter(iterable)
+    return iter(lambda: list(islice(it, n)), [])
 
 
 def list_all_qualification_types(client: MTurkClient) \
@@ -108,26 +139,51 @@ def list_all_qualification_types(client: MTurkClient) \
     :return: List of qualification type dicts
     :rtype: list[dict[str, any]]
     """
-    results = []
+    pages = client.get_paginator('list_qualification_types').paginate(
+        MustBeRequestable=False,
+        MustBeOwnedByCaller=True,
+        PaginationConfig={'PageSize': 100}
+    )
+
+    return [qt for page in pages for qt in page['QualificationTypes']]
 
-    q = client.list_qualification_types(
-        MaxResults=100,
+
+def find_qualification_type_id(client: MTurkClient,
+                               name: str) \
+        -> Optional[str]:
+    """ Find the ID of a qualification type of the AMT client by its name
+
+    The search is done on AMT, so only the qualification types matching the name are fetched.
+
+    :param client: AMT client
+    :type client: botocore.client.BaseClient
+    :param name: Exact name of the qualification type
+    :type name: str
+    :return: Qualification type ID or None if there is no such qualification type
+    :rtype: str | None
+    """
+    pages = client.get_paginator('list_qualification_types').paginate(
+        Query=name,
         MustBeRequestable=False,
-        MustBeOwnedByCaller=True
+        MustBeOwnedByCaller=True,
+        PaginationConfig={'PageSize': 100}
     )
 
-    while q["NumResults"] > 0:
-        nt = q["NextToken"]
-        results.extend(q["QualificationTypes"])
+    # The query also matches other names containing the given one, e.g. Batch 1 -> Batch 10,
+    # so the exact name may be on any page
+    qids = [
+        qt['QualificationTypeId']
+        for page in pages
+        for qt in page['QualificationTypes']
+        if qt['Name'] == name
+    ]
 
-        q = client.list_qualification_types(
-            MaxResults=100,
-            MustBeRequestable=False,
-            MustBeOwnedByCaller=True,
-            NextToken=nt
-        )
+    if not qids:
+        return None
+    if len(qids) > 1:
+        print(f'Found {len(qids)} qualification types named "{name}", using {qids[0]}.')
 
-    return results
+    return qids[0]
 
 
 def create_custom_qualifications(client: MTurkClient) \
@@ -144,17 +200,21 @@ def create_custom_qualifications(client: MTurkClient) \
         'BATCH': []
     }
 
-    q_types = list_all_qualification_types(client)
+    batch_names = [f'Participated in annotation Batch {rnd}' for rnd in range(1, 11)]
+    blacklist_name = 'Experimental settings'
 
-    q_names = [qt['Name'] for qt in q_types]
+    # Look up the existing qualification types concurrently, one request per name
+    names = batch_names + [blacklist_name]
+    with ThreadPoolExecutor(max_workers=len(names)) as executor:
+        qids = executor.map(lambda n: find_qualification_type_id(client, n), names)
+        name_to_id = {name: qid for name, qid in zip(names, qids) if qid is not None}
 
-    for rnd in range(1, 11):
-        name = f'Participated in annotation Batch {rnd}'
+    for name in batch_names:
         desc = 'Workers with this qualification have already participated in ' \
                'this batch and will not be able to ' \
                'participate in this batch anymore.'
 
-        if name not in q_names:
+        if name not in name_to_id:
             resp = client.create_qualification_type(
                 Name=name,
                 Description=desc,
@@ -166,12 +226,11 @@ def create_custom_qualifications(client: MTurkClient) \
             )
             qid = resp['QualificationType']['QualificationTypeId']
         else:
-            qid = [qt['QualificationTypeId'] for qt in q_types if qt['Name'] == name][0]
+            qid = name_to_id[name]
 
         custom_qualifications['BATCH'].append(qid)
 
-    blacklist_name = 'Experimental settings'
-    if blacklist_name not in q_names:
+    if blacklist_name not in name_to_id:
         resp = client.create_qualification_type(
             Name=blacklist_name,
             Description=blacklist_name,
@@ -180,46 +239,36 @@ def create_custom_qualifications(client: MTurkClient) \
         )
         qid = resp['QualificationType']['QualificationTypeId']
     else:
-        qid = [qt['QualificationTypeId'] for qt in q_types if qt['Name'] == blacklist_name][0]
+        qid = name_to_id[blacklist_name]
 
     custom_qualifications['BLACKLIST'] = qid
 
     return custom_qualifications
 
 
-def list_qualifications_for_hit(config: MutableMapping[str, Any],
+def list_qualifications_for_hit(task: Task,
                                 custom_qualifications: MutableMapping[str, Union[str, List[str]]]) \
-        -> List[Dict[str, Any]]:
+        -> Tuple[Dict[str, Any], ...]:
     """ Create a list of the needed qualifications for the HIT
 
-    :param config: HIT settings
-    :type config: dict
+    The result is shared by all the HITs (and publishing threads), so it is
+    returned as a tuple and the qualifications must not be modified.
+
+    :param task: The task to publish
+    :type task: Task
     :param custom_qualifications: Custom qualifications
     :type custom_qualifications: dict[str, any]
-    :return: List of needed qualifications for HIT
-    :rtype: list[dict[atr, any]]
+    :return: Needed qualifications for HIT
+    :rtype: tuple[dict[str, any], ...]
     """
-    task_config = config['TASKS'][
-        config['CURRENT']['task']
-    ]
-
-    # If task has specific defined requirements, use those instead of global ones
-    if 'REQUIREMENTS' in task_config:
-        approval_rating, approved_hits, locations = \
-            tuple(
-                [task_config['REQUIREMENTS'][q_name] for q_name in {'APPROVAL_RATE', 'APPROVED_HITS', 'LOCATION'}]
-            )
-    else:
-        approval_rating, approved_hits, locations = \
-            tuple(
-                [config['REQUIREMENTS'][q_name] for q_name in ['APPROVAL_RATE', 'APPROVED_HITS', 'LOCATION']]
-            )
+    approval_rating, approved_hits, locations = \
+        [task.requirements[q_name] for q_name in ['APPROVAL_RATE', 'APPROVED_HITS', 'LOCATION']]
 
     qualifications = [{
         # Location qualification
         'ActionsGuarded': 'Accept',
         'Comparator': 'In',
-        'LocaleValues': [{'Country': c} for c in locations],
+        'LocaleValues': tuple({'Country': c} for c in locations),
         'QualificationTypeId': '00000000000000000071',
         "RequiredToPreview": False
     }, {
@@ -239,7 +288,7 @@ def list_qualifications_for_hit(config: MutableMapping[str, Any],
     }]
 
     # Blacklist and batch qualifications not needed for sandbox testing
-    if not config['USE_SANDBOX']:
+    if not task.use_sandbox:
         # Add blacklist qualification
         qualifications.append({
             'ActionsGuarded': 'DiscoverPreviewAndAccept',
@@ -252,12 +301,12 @@ def list_qualifications_for_hit(config: MutableMapping[str, Any],
             'ActionsGuarded': 'Accept',
             'Comparator': 'DoesNotExist',
             'QualificationTypeId': custom_qualifications['BATCH'][
-                config['CURRENT']['batch'] - 1
+                task.batch - 1
             ],
             'RequiredToPreview': False
         })
 
-    return qualifications
+    return tuple(qualifications)
 
 
 def input_layout_params_into_html(html: str,
@@ -281,54 +330,47 @@ def input_layout_params_into_html(html: str,
     :return: The HTML with the placeholders replaces
     :rtype: str
     """
+    values = {param['Name']: param['Value'] for param in layout_params}
+
     # See if all the expected parameters are given in layout_params
-    expected_params = set(
-        [the_param[2:-1] for the_param in re.findall(r"\${[a-zA-Z_1-9]+\}", html)]
+    expected_params = set(_PLACEHOLDER_RE.findall(html))
+    for param in expected_params - values.keys():
+        # if verbose:
+        print(f'Expected layout parameter {param} not given.')
+
+    if verbose:
+        for param in values.keys() - expected_params:
+            print(f'Unexpected layout parameter: {param}.')
+
+    # Replace all the placeholders in a single pass
+    return _PLACEHOLDER_RE.sub(
+        lambda m: values.get(m.group(1), m.group(0)),
+        html
     )
-    given_params = set([the_param['Name'] for the_param in layout_params])
-    for param in expected_params:
-        if param not in given_params:
-            # if verbose:
-            print(f'Expected layout parameter {param} not given.')
-
-    # Replace the placeholders
-    new_html = html
-    for param in layout_params:
-        to_replace = '${' + param['Name'] + '}'
-        if to_replace not in new_html:
-            if verbose:
-                print(f'Unexpected layout parameter: {param["Name"]}.')
-
-        new_html = new_html.replace(
-            '${' + param["Name"] + '}',
-            param['Value']
-        )
-
-    return new_html
 
 
-def wrap_layout_into_question(html: str,
-                              mturk_form_action: str,
-                              config: Dict[str, Union[str, int]]) \
+def read_question_template(mturk_form_action: str,
+                           config: Dict[str, Union[str, int]]) \
         -> str:
-    """ Wrap an HTML layout into an HTMLQuestion
+    """ Read the HTMLQuestion wrappers and fill in everything but the HIT layout.
+
+    The result is meant to be read once and passed to wrap_layout_into_question
+    for each HIT.
 
-    :param config: Layout settings, including template file paths and frame height
-    :type config: dict[str, str | int]
     :param mturk_form_action: What URL to use for the form action on mturk.
                             Depends on whether or not sandbox is in use.
     :type mturk_form_action: str
-    :param html: HTML to wrap
-    :type html: str
-    :return: The wrapped HTML
+    :param config: Layout settings, including template file paths and frame height
+    :type config: dict[str, str | int]
+    :return: The HTMLQuestion template
     :rtype: str
     """
-    html_template = open(config['HTML_wrapper'], 'r').read()
-    xml_template = open(config['question_wrapper'], 'r').read()
+    html_template = Path(config['HTML_wrapper']).read_text()
+    xml_template = Path(config['question_wrapper']).read_text()
 
     html_content = html_template.format(
         mturk_form_action=mturk_form_action,
-        hit_layout=html
+        hit_layout=_HIT_LAYOUT_SLOT
     )
     xml = xml_template.format(
         html_content=html_content,
@@ -338,6 +380,21 @@ def wrap_layout_into_question(html: str,
     return xml
 
 
+def wrap_layout_into_question(html: str,
+                              question_template: str) \
+        -> str:
+    """ Wrap an HTML layout into an HTMLQuestion
+
+    :param html: HTML to wrap
+    :type html: str
+    :param question_template: HTMLQuestion template from read_question_template
+    :type question_template: str
+    :return: The wrapped HTML
+    :rtype: str
+    """
+    return question_template.replace(_HIT_LAYOUT_SLOT, html)
+
+
 def main():
     config = read_yaml('config.yaml')
     aws_keys = read_yaml('aws_keys.yaml')
@@ -381,91 +438,141 @@ def main():
 
             write_yaml(custom_qualifications, 'custom_qualifications.yaml')
 
-        qualifications = list_qualifications_for_hit(config, custom_qualifications)
+        qualifications = list_qualifications_for_hit(task, custom_qualifications)
     else:
-        qualifications = []
+        qualifications = ()
 
-    N = len([1 for _ in open(config['CURRENT']['input_data_file'])]) - 1
+    # Count the rows without decoding them, minus the header row
+    with open(config['CURRENT']['input_data_file'], 'rb') as f:
+        N = sum(1 for _ in f) - 1
     constants = {'unique_id': task.ut_id}
 
     if task.collapse_token is not None:
         constants['collapse_token'] = task.collapse_token
 
-    layout_file = Path(
-        config['TASKS'][config['CURRENT']['task']]['LAYOUT_FILE']
-    )
+    layout_file = Path(task.task_config['LAYOUT_FILE'])
     with layout_file.open('r') as f:
         layout_html = f.read()
 
-    for layout_params, param_dict in tqdm(
-            layout_params_from_file(
-                config['CURRENT']['input_data_file'],
-                constants=constants
-            ),
-            total=N
-    ):
-
-        contains_type = 0
-        try:
-            for i, params in enumerate(layout_params):
-                # audioType is the same for all, so it can be added automatically if not in the file.
-                if params['Name'] == 'audioType':
-                    contains_type = 1
-                # Replace non-ASCII
-                elif params['Name'] in ['DescriptionText', 'EditedCaption', 'captions']:
-                    layout_params[i] = {
-                        'Name': params['Name'],
-                        # AMT requires ASCII-only
-                        'Value': replace_non_ascii(params['Value']).replace('"', "'")
-                    }
-        except:
-            pass
-        if contains_type == 0:
-            layout_params.append({'Name': 'audioType', 'Value': 'audio/wav'})
-
-        for i in layout_params:
-            if i['Name'] in ['file_name', 'audioUrl']:
-                assert i['Value'].endswith('.wav')
+    # Constants are the same for all the HITs, so they are filled in only once
+    for k, v in constants.items():
+        layout_html = layout_html.replace('${' + k + '}', v)
+
+    question_template = read_question_template(mturk_form_action, config['LAYOUT'])
+
+    # HIT parameters that are the same for all the HITs
+    base_kwargs = {
+        'LifetimeInSeconds': 14 * 24 * 3600,
+        'AssignmentDurationInSeconds': 20 * 60,
+        'Reward': task.reward,
+        'Title': task.title,
+        'Description': task.desc,
+        'Keywords': task.keywords,
+        'QualificationRequirements': qualifications,
+        'RequesterAnnotation': req_annotation
+    }
+    max_assigns = task.max_assigns
+    create_hit = client.create_hit
 
+    # Rows with the same layout parameters (e.g. when re-publishing) can reuse the same question.
+    # Off by default, since rows are usually unique and each question takes ~20 KB.
+    @lru_cache(maxsize=config.get('QUESTION_CACHE_SIZE', 0))
+    def render_question(param_items):
         question_html = input_layout_params_into_html(
             layout_html,
-            layout_params
+            [{'Name': k, 'Value': v} for k, v in param_items]
         )
-        question = wrap_layout_into_question(
+        return wrap_layout_into_question(
             question_html,
-            mturk_form_action,
-            config['LAYOUT']
+            question_template
         )
 
-        hit_kwargs = {
-            'LifetimeInSeconds': 14 * 24 * 3600,
-            'AssignmentDurationInSeconds': 20 * 60,
-            'Reward': task.reward,
-            'Title': task.title,
-            'Description': task.desc,
-            'Keywords': task.keywords,
-            'Question': question,
-            'QualificationRequirements': qualifications,
-            'RequesterAnnotation': req_annotation
-        }
+    def publish_one(row):
+        """ Build the HIT of one input file row and publish it """
+        layout_params, param_dict = row
+
+        # Replace non-ASCII
+        for params in layout_params:
+            if params['Name'] in _CLEAN_FIELDS:
+                params['Value'] = replace_non_ascii(params['Value'].replace('"', "'"))
+
+        # audioType is the same for all, so it can be added automatically if not in the file.
+        if 'audioType' not in param_dict:
+            layout_params.append({'Name': 'audioType', 'Value': 'audio/wav'})
+            param_dict['audioType'] = 'audio/wav'
+
+        for name in ('file_name', 'audioUrl'):
+            value = param_dict.get(name)
+            assert value is None or value.endswith('.wav')
+
+        question = render_question(
+            tuple((params['Name'], params['Value']) for params in layout_params)
+        )
 
         if 'MaxAssignments' in param_dict:
-            hit_kwargs['MaxAssignments'] = int(param_dict['MaxAssignments'])
+            ma = int(param_dict['MaxAssignments'])
         elif 'SubmissionsReceived' in param_dict:
-            ma = task.max_assigns - int(param_dict['SubmissionsReceived'])
+            ma = max_assigns - int(param_dict['SubmissionsReceived'])
             if ma < 0:
                 print(f'Error with HIT parameters: Cannot publish less than 0 assignments!')
                 ma = 0
-            hit_kwargs['MaxAssignments'] = ma
         else:
-            hit_kwargs['MaxAssignments'] = task.max_assigns
+            ma = max_assigns
+
+        # botocore retries a timed-out request with the same parameters. If AMT already
+        # created the HIT, the token makes it reject the retry instead of publishing a duplicate.
+        return create_hit(
+            Question=question,
+            MaxAssignments=ma,
+            UniqueRequestToken=uuid.uuid4().hex,
+            **base_kwargs
+        )
 
-        resp = client.create_hit(**hit_kwargs)
+    hit_ids = []
+    hit_group_id = None
+    failed = 0
+    complete = False
+
+    try:
+        # HITs are independent requests, so several can be in flight at once.
+        # The client is shared by all the worker threads. Rows are submitted in
+        # chunks to keep the number of pending futures bounded.
+        with ThreadPoolExecutor(max_workers=config.get('MAX_IN_FLIGHT', 16)) as executor, \
+                tqdm(total=N) as progress:
+            for chunk in chunks(layout_params_from_file(config['CURRENT']['input_data_file']), _CHUNK_SIZE):
+                futures = [executor.submit(publish_one, row) for row in chunk]
+
+                for future in as_completed(futures):
+                    progress.update()
+                    # A rejected HIT or a request that failed after all its retries
+                    # should not stop the others from being published
+                    try:
+                        resp = future.result()
+                    except (botocore.exceptions.ClientError, botocore.exceptions.BotoCoreError) as e:
+                        print(f'Could not publish HIT: {e}')
+                        failed += 1
+                        continue
+
+                    hit_ids.append(resp['HIT']['HITId'])
+                    hit_group_id = resp['HIT']['HITGroupId']
+
+        # A failed request may still have published its HIT, e.g. on a read timeout
+        complete = failed == 0
+    finally:
+        # Record the published HITs even if publishing stopped on an error,
+        # so that their results can be fetched by HITId
+        record_hit_ids(
+            config.get('HIT_IDS_FILE', './data/hit_ids.json'),
+            get_endpoint_url(config),
+            req_annotation,
+            hit_ids,
+            complete
+        )
 
     print(
-        f'Published {N} HITs with:'
+        f'Published {len(hit_ids)}/{N} HITs with:'
         f'\n\tTitle: {task.title}'
-        f'\n\tHIT Group Id: {resp["HIT"]["HITGroupId"]}'
+        f'\n\tHIT Group Id: {hit_group_id}'
     )
 
 
@@ -2,20 +2,38 @@
 # -*- coding: utf-8 -*-
 
 import csv
+import os
+import xml.etree.ElementTree as ET
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import MutableMapping, List, Union, NewType, Any, Tuple, Dict
+from typing import MutableMapping, List, Union, NewType, Any, Tuple, Dict, Optional, Callable, \
+    Iterable, Iterator
 
-import xmltodict
-import botocore
+import botocore.client
+import botocore.exceptions
 
-from tools import get_client, get_req_annotation_for_batch, read_yaml, replace_non_ascii
+try:
+    # Rust implementation of the xmltodict API, faster than ElementTree if installed
+    import xmltodict_rs
+except ImportError:
+    xmltodict_rs = None
+
+from tools import get_client, get_endpoint_url, get_req_annotation_for_batch, read_yaml, read_hit_ids, \
+    replace_non_ascii
 
 __author__ = 'Samuel Lipping -- Tampere University'
 __docformat__ = 'reStructuredText'
-__all__ = ['test_hit', 'get_answer_data',
+__all__ = ['test_hit', 'make_hit_test', 'parse_answers', 'get_answer_data',
+           'get_answer_rows',
+           'stream_answer_data',
            'write_ans_data_file',
+           'write_ans_rows',
            'get_all_hits',
+           'iter_all_hits',
+           'get_hits_by_id',
            'get_hit_assignments',
+           'iter_all_assignments',
            'get_all_assignments']
 
 # For easier type hinting
@@ -23,6 +41,12 @@ MTurkClient = NewType('MTurkClient', botocore.client.BaseClient)
 DataDict = NewType('DataDict', MutableMapping[str, Any])
 ResultDict = NewType('ResultDict', MutableMapping[str, List[str]])
 
+# Assignment statuses accepted by list_assignments_for_hit
+_ASSIGNMENT_STATUSES = frozenset(('Submitted', 'Approved', 'Rejected'))
+# Columns of the results before the answers
+_ANSWER_HEADER = ('HITId', 'Title', 'AssignmentId', 'WorkerId', 'AssignmentStatus', 'RejectionTime',
+                  'RequesterAnnotation')
+
 
 def test_hit(hit: DataDict,
              params: MutableMapping[str, List[Any]]) \
@@ -41,30 +65,181 @@ def test_hit(hit: DataDict,
     :return: True if parameters hold true, False if not
     :rtype: bool
     """
+    if not params:
+        return True
 
-    def test_one(p, h):
-        if p == '':
-            return p == h
-        else:
-            if p[0] == '+':
-                if h.startswith(p[1:]):
-                    return True
-            elif p[0] == '-':
-                if h.endswith(p[1:]):
-                    return True
-            else:
-                return p == h
+    return make_hit_test(params)(hit)
 
-    for i in params:
-        if i not in hit:
-            return False
-        pars = params[i]
-        if any(test_one(p, hit[i]) for p in pars):
-            continue
-        else:
+
+def make_hit_test(params: MutableMapping[str, List[Any]]) \
+        -> Callable[[DataDict], bool]:
+    """ Create a function that tests a HIT (or assignment) for given parameters
+    like test_hit. The parameters are processed only once, so the function is
+    meant to be used when testing many HITs with the same parameters.
+
+    :param params: Parameters to test with. See test_hit.
+    :type params: dict[str, list[any]]
+    :return: Function returning True if parameters hold true for a HIT, False if not
+    :rtype: callable
+    """
+    # No parameters (the default) means every HIT passes
+    if not params:
+        return lambda hit: True
+
+    # For each key: exact values, prefixes ('+' values) and suffixes ('-' values)
+    compiled = []
+    for key, pars in params.items():
+        exact = tuple(p for p in pars if p == '' or p[0] not in '+-')
+        prefixes = tuple(p[1:] for p in pars if p != '' and p[0] == '+')
+        suffixes = tuple(p[1:] for p in pars if p != '' and p[0] == '-')
+        compiled.append((key, exact, prefixes, suffixes))
+
+    def test(hit):
+        for key, exact, prefixes, suffixes in compiled:
+            if key not in hit:
+                return False
+            h = hit[key]
+            if h in exact:
+                continue
+            if isinstance(h, str) and ((prefixes and h.startswith(prefixes))
+                                       or (suffixes and h.endswith(suffixes))):
+                continue
             return False
 
-    return True
+        return True
+
+    return test
+
+
+def parse_answers(answer_xml: str) \
+        -> List[Tuple[str, Any]]:
+    """ Parse the answers of an assignment from its QuestionFormAnswers XML
+
+    Only the question identifiers and answer values are extracted. As with
+    xmltodict, surrounding whitespace is stripped, empty values are None and
+    the values of a multi-select answer are a list.
+
+    :param answer_xml: The Answer field of an assignment
+    :type answer_xml: str
+    :return: (QuestionIdentifier, value) of each answer
+    :rtype: list[tuple[str, any]]
+    """
+    answers = []
+
+    if xmltodict_rs is not None:
+        parsed = xmltodict_rs.parse(answer_xml)['QuestionFormAnswers']['Answer']
+        # A single answer is not wrapped in a list
+        if isinstance(parsed, dict):
+            parsed = [parsed]
+
+        for answer in parsed:
+            val = ''
+            for key in answer:
+                if key != 'QuestionIdentifier':
+                    val = answer[key]
+            answers.append((answer['QuestionIdentifier'], val))
+
+        return answers
+
+    for answer in ET.fromstring(answer_xml):
+        var_name = None
+        # Values by tag. As with xmltodict, a repeated tag (e.g. SelectionIdentifier
+        # of a multi-select answer) has a list of its values.
+        values = {}
+        for element in answer:
+            text = (element.text or '').strip() or None
+            # Tags are namespaced, e.g. {http://...}QuestionIdentifier
+            tag = element.tag.rpartition('}')[2]
+            if tag == 'QuestionIdentifier':
+                var_name = text
+            elif tag not in values:
+                values[tag] = text
+            elif isinstance(values[tag], list):
+                values[tag].append(text)
+            else:
+                values[tag] = [values[tag], text]
+
+        # The value of the last answer tag, like the xmltodict version
+        answers.append((var_name, next(reversed(values.values()), '')))
+
+    return answers
+
+
+def get_answer_rows(client: MTurkClient,
+                    hit_search_params: DataDict = {},
+                    assignment_search_params: DataDict = {},
+                    max_hits: int = -1,
+                    stop_after_first: bool = False,
+                    hit_ids: Optional[List[str]] = None,
+                    max_workers: int = 16) \
+        -> Optional[Tuple[List[str], Iterator[Dict[str, Any]]]]:
+    """ Get all assignment data, i.e. answers, from AMT for the given client
+    and HIT and assignment search parameters as rows.
+    The rows are generated one by one, so they can be written without
+    collecting all of them first.
+
+    See get_answer_data for the parameters.
+
+    :return: The column names and a generator of the rows, one for each assignment.
+    A row is a dict with the column names as keys. Answers missing from an assignment
+    are missing from its row. None if the search parameters are invalid.
+    :rtype: tuple[list[str], iterator[dict[str, any]]] | None
+    """
+    header = list(_ANSWER_HEADER)
+    answer_names = []
+
+    try:
+        assignments, hit_data = get_all_assignments(
+            client,
+            hit_search_params=hit_search_params,
+            assignment_search_params=assignment_search_params,
+            max_hits=max_hits,
+            stop_after_first_hit=stop_after_first,
+            hit_ids=hit_ids,
+            max_workers=max_workers
+        )
+    except TypeError:
+        print('Invalid search parameters!')
+        return None
+
+    # Parse each answer only once
+    parsed_answers = [parse_answers(assignment['Answer']) for assignment in assignments]
+
+    # Get all answer names from data, in the order they are first seen
+    seen = set(header)
+    for answers in parsed_answers:
+        for var_name, _ in answers:
+            if var_name not in seen:
+                seen.add(var_name)
+                answer_names.append(var_name)
+
+    def rows():
+        for assignment, answers in zip(assignments, parsed_answers):
+            yield _answer_row(assignment, hit_data[assignment['HITId']], answers)
+
+    return header + answer_names, rows()
+
+
+def _answer_row(assignment: DataDict,
+                hit: DataDict,
+                answers: List[Tuple[str, Optional[str]]]) \
+        -> Dict[str, Any]:
+    """ Make a result row of an assignment
+
+    :param assignment: The assignment
+    :type assignment: dict[str, any]
+    :param hit: The HIT of the assignment
+    :type hit: dict[str, any]
+    :param answers: Parsed answers of the assignment
+    :type answers: list[(str, str | None)]
+    :return: The row with the column names as keys
+    :rtype: dict[str, any]
+    """
+    # HIT info first, then assignment info, e.g. RejectionTime is missing if not rejected
+    row = {h: hit.get(h, assignment.get(h, "")) for h in _ANSWER_HEADER}
+    row.update(answers)
+
+    return row
 
 
 def get_answer_data(client: MTurkClient,
@@ -73,7 +248,9 @@ def get_answer_data(client: MTurkClient,
                     assignment_search_params: DataDict = {},
                     write: bool = True,
                     max_hits: int = -1,
-                    stop_after_first: bool = False) \
+                    stop_after_first: bool = False,
+                    hit_ids: Optional[List[str]] = None,
+                    max_workers: int = 16) \
         -> ResultDict:
     """ Get all assignment data, i.e. answers, from AMT for the given client
     and HIT and assignment search parameters.
@@ -97,71 +274,95 @@ def get_answer_data(client: MTurkClient,
     :param stop_after_first: Whether to stop fetching HITs on the first HIT
     satisfying hit_search_params.
     :type stop_after_first: bool
+    :param hit_ids: HITIds of the HITs to fetch. If given, only these HITs are fetched
+    instead of going through all the HITs.
+    :type hit_ids: list[str] | None
+    :param max_workers: Max number of concurrent requests to AMT
+    :type max_workers: int
     :return: The assignments fetched from AMT. The format is a dict with a key for each
     column with the value being a list of the rows in that column.
     I.e. results['AssignmentStatus'][10] is the value of 'AssignmentStatus' of the
     11th assignment.
     :rtype: dict[str, list[str]]
     """
-    header = ['HITId', 'Title', 'AssignmentId', 'WorkerId', 'AssignmentStatus', 'RejectionTime', 'RequesterAnnotation']
-    answer_names = []
-    results = {}
-
-    try:
-        assignments, hit_data = get_all_assignments(
-            client,
-            hit_search_params=hit_search_params,
-            assignment_search_params=assignment_search_params,
-            max_hits=max_hits,
-            stop_after_first_hit=stop_after_first
-        )
-    except TypeError:
-        print('Invalid search parameters!')
+    answer_rows = get_answer_rows(
+        client,
+        hit_search_params=hit_search_params,
+        assignment_search_params=assignment_search_params,
+        max_hits=max_hits,
+        stop_after_first=stop_after_first,
+        hit_ids=hit_ids,
+        max_workers=max_workers
+    )
+    if answer_rows is None:
         return
 
-    # Get all answer names from data
-    for assignment in assignments:
-        answers = xmltodict.parse(assignment['Answer'])['QuestionFormAnswers']['Answer']
-        for answer in answers:
-            var_name = answer['QuestionIdentifier']
-            if var_name not in header and var_name not in answer_names:
-                answer_names.append(var_name)
+    columns, rows = answer_rows
+    rows = list(rows)
 
-    for h in header:
-        results[h] = []
-    for name in answer_names:
-        results[name] = []
-    for assignment in assignments:
-        hit = hit_data[assignment['HITId']]
-        answers = xmltodict.parse(assignment['Answer'])['QuestionFormAnswers']['Answer']
-
-        for h in header:
-            if h in hit:
-                results[h].append(hit[h])
-            elif h in assignment:
-                results[h].append(assignment[h])
-            else:
-                results[h].append("")
+    if write:
+        write_ans_rows(rows, columns, ofile)
 
-        for answer in answers:
-            var_name = answer['QuestionIdentifier']
-            val = ''
-            for key in answer:
-                if key != 'QuestionIdentifier':
-                    val = answer[key]
+    # Fill nonexisting answers with blank spaces
+    return {name: [row.get(name, '') for row in rows] for name in columns}
 
-            results[var_name].append(val)
 
-        # Fill nonexisting answers with blank spaces
-        count = len(results['HITId'])
-        for name in answer_names:
-            if len(results[name]) != count:
-                results[name].append('')
+def _clean_cell(value: Any) \
+        -> str:
+    """ Turn a value into an ASCII csv cell, empty values into empty strings
 
-    if write:
-        write_ans_data_file(results, ofile)
+    :param value: Value to write
+    :type value: any
+    :return: The cell
+    :rtype: str
+    """
+    if not value:
+        return u''
+
+    # Replace non-ASCII characters with ASCII characters, e.g. ç -> c.
+    return replace_non_ascii(value)
 
-    return results
+
+def write_ans_rows(rows: Iterable[Dict[str, Any]],
+                   columns: List[str],
+                   ofile: str,
+                   ignore: List[str] = [],
+                   select: Union[List[str], str] = []) \
+        -> None:
+    """ Write a csv file from the given rows, one row at a time
+
+    :param rows: Rows to write to csv, e.g. from get_answer_rows
+    :type rows: iterable[dict[str, any]]
+    :param columns: Column names of the rows
+    :type columns: list[str]
+    :param ofile: Output file path
+    :type ofile: str
+    :param ignore: List of keys (columns) to ignore
+    :type ignore: list[str]
+    :param select: List of keys (columns) to select or 'score' to select keys associated
+    with the score task. Selects all keys by default.
+    :type select: list[str] or str
+    """
+    if select == []:
+        select = list(columns)
+    elif select == 'score':
+        select = ['HITId', 'Title', 'AssignmentId', 'WorkerId', 'assignments', 'audioUrl', 'captions',
+                  'accuracy_scores', 'fluency_scores', 'Feedback']
+
+    Path(ofile).parent.mkdir(exist_ok=True, parents=True)
+
+    with open(ofile, 'w', newline='\n', buffering=1 << 20, encoding='utf-8') as f:
+        writer = csv.writer(f, delimiter=',')
+        ignore = set(ignore)
+        column_set = set(columns)
+        titles = [i for i in select if i not in ignore and i in column_set]
+        writer.writerow(titles)
+
+        # titles already satisfy ignore and select, so each row only needs to be picked and cleaned
+        writer.writerows(
+            map(_clean_cell, map(data_row.get, titles))
+            for data_row in rows
+        )
 
 
 def write_ans_data_file(data: ResultDict,
@@ -181,32 +382,117 @@ def write_ans_data_file(data: ResultDict,
     with the score task. Selects all keys by default.
     :type select: list[str] or str
     """
-    if select == []:
-        select = list(data.keys())
-    elif select == 'score':
-        select = ['HITId', 'Title', 'AssignmentId', 'WorkerId', 'assignments', 'audioUrl', 'captions',
-                  'accuracy_scores', 'fluency_scores', 'Feedback']
+    columns = list(data.keys())
+    rows = (dict(zip(columns, values)) for values in zip(*data.values()))
+
+    write_ans_rows(rows, columns, ofile, ignore=ignore, select=select)
+
+
+def stream_answer_data(client: MTurkClient,
+                       ofile: str,
+                       hit_search_params: DataDict = {},
+                       assignment_search_params: DataDict = {},
+                       hit_ids: Optional[List[str]] = None,
+                       max_workers: int = 16,
+                       flush_every: int = 100) \
+        -> int:
+    """ Write all assignment data, i.e. answers, from AMT into a csv file as the
+    assignments are fetched. The file is flushed every flush_every rows, so the
+    rows written so far are kept even if the script is interrupted.
+
+    The columns are set by the first assignment. Answers first seen in later
+    assignments are added as columns at the end, so the file is the same as
+    the one written by get_answer_data.
+
+    See get_answer_data for the other parameters.
+
+    :param flush_every: Number of rows to write between flushes
+    :type flush_every: int
+    :return: Number of written rows
+    :rtype: int
+    """
+    # Check the search parameters before anything is fetched or written
+    try:
+        make_hit_test(hit_search_params)
+        make_hit_test(assignment_search_params)
+    except TypeError:
+        print('Invalid search parameters!')
+        return 0
+
+    columns = None
+    extra_names = []
+    extra_values = {}
+    written = 0
 
     Path(ofile).parent.mkdir(exist_ok=True, parents=True)
 
-    with open(ofile, 'w', newline='\n') as f:
+    with open(ofile, 'w', newline='\n', buffering=1 << 20, encoding='utf-8') as f:
         writer = csv.writer(f, delimiter=',')
-        titles = [i for i in select if i not in ignore and i in data]
-        writer.writerow(titles)
 
-        for i in range(len(data[titles[0]])):
-            row = [data[j][i] for j in titles if j not in ignore and j in select]
-            for j in range(len(row)):
-                if not row[j]:
-                    row[j] = u''
-                else:
-                    try:
-                        row[j] = str(row[j]).encode('ASCII').decode()
-                    except:
-                        # Replace non-ASCII characters with ASCII characters, e.g. á -> a.
-                        row[j] = replace_non_ascii(row[j])
+        try:
+            for hit, assignments in iter_all_assignments(
+                    client,
+                    hit_search_params=hit_search_params,
+                    assignment_search_params=assignment_search_params,
+                    hit_ids=hit_ids,
+                    max_workers=max_workers):
+                for assignment in assignments:
+                    row = _answer_row(assignment, hit, parse_answers(assignment['Answer']))
+
+                    if columns is None:
+                        columns = list(row)
+                        column_set = set(columns)
+                        writer.writerow(columns)
+
+                    # Keep the answers missing from the columns until the end
+                    extra = {name: val for name, val in row.items() if name not in column_set}
+                    if extra:
+                        extra_names.extend(name for name in extra if name not in extra_names)
+                        extra_values[written] = extra
+
+                    writer.writerow([_clean_cell(row.get(name)) for name in columns])
+                    written += 1
+                    if written % flush_every == 0:
+                        f.flush()
+        except KeyboardInterrupt:
+            print(f'Interrupted by user! Wrote {written} assignments to {ofile}')
+
+        if columns is None:
+            writer.writerow(_ANSWER_HEADER)
+
+    if extra_names:
+        _add_csv_columns(ofile, extra_names, extra_values)
+
+    return written
+
+
+def _add_csv_columns(ofile: str,
+                     names: List[str],
+                     values: Dict[int, Dict[str, Any]]) \
+        -> None:
+    """ Add columns to the end of a csv file written by stream_answer_data
+
+    :param ofile: The csv file
+    :type ofile: str
+    :param names: Names of the new columns
+    :type names: list[str]
+    :param values: Values of the new columns by the index of the row.
+    Rows without values are left empty.
+    :type values: dict[int, dict[str, any]]
+    """
+    tmp_file = f'{ofile}.tmp'
+
+    with open(ofile, 'r', newline='', encoding='utf-8') as src, \
+            open(tmp_file, 'w', newline='\n', buffering=1 << 20, encoding='utf-8') as dst:
+        reader = csv.reader(src)
+        writer = csv.writer(dst, delimiter=',')
+        writer.writerow(next(reader) + names)
+
+        for i, line in enumerate(reader):
+            row = values.get(i, {})
+            writer.writerow(line + [_clean_cell(row.get(name)) for name in names])
 
-            writer.writerow(row)
+    os.replace(tmp_file, ofile)
 
 
 def get_all_hits(client: MTurkClient,
@@ -231,18 +517,41 @@ def get_all_hits(client: MTurkClient,
     :return: List of fetched HITs
     :rtype: list[dict[str, any]]
     """
-    results = []
+    return list(iter_all_hits(
+        client,
+        hit_search_params=hit_search_params,
+        print_info=print_info,
+        max_hits=max_hits,
+        stop_after_first=stop_after_first
+    ))
+
+
+def iter_all_hits(client: MTurkClient,
+                  hit_search_params: DataDict = {},
+                  print_info: bool = True,
+                  max_hits: int = -1,
+                  stop_after_first: bool = False) \
+        -> Iterator[DataDict]:
+    """ Generates all HITs from AMT for given client and parameters as they are fetched.
+    See get_all_hits for the parameters.
+
+    :return: Generator of fetched HITs
+    :rtype: iterator[dict[str, any]]
+    """
     gathered = 0
     processed = 0
     done = 0
     if print_info:
         print('Gathering HITs... Ctrl+C to interrupt')
 
-    q = client.list_hits(MaxResults=100)
+    hit_test = make_hit_test(hit_search_params)
+    pages = client.get_paginator('list_hits').paginate(
+        PaginationConfig={'PageSize': 100}
+    )
     try:
-        while q['NumResults'] > 0:
-            nt = q['NextToken']
-            for hit in q['HITs']:
+        # Pages are fetched lazily, so no more are fetched after breaking out
+        for page in pages:
+            for hit in page['HITs']:
                 if 0 < max_hits <= processed:
                     done = 1
                     break
@@ -250,25 +559,54 @@ def get_all_hits(client: MTurkClient,
                 if print_info and processed % 100 == 0:
                     print(f'\rGathered: {gathered}\t\tProcessed: {processed}', end='', flush=True)
                 processed += 1
-                if not test_hit(hit, hit_search_params):
+                if not hit_test(hit):
                     if gathered != 0 and stop_after_first:
                         done = 1
                         break
                     continue
 
-                results.append(hit)
+                yield hit
                 gathered += 1
 
             if done:
                 break
-            q = client.list_hits(NextToken=nt, MaxResults=100)
     except KeyboardInterrupt:
         print(f'Interrupted by user! Got {gathered} HITs.')
 
     if print_info:
         print('\rGathered: %s\t\tProcessed: %s' % (gathered, processed))
 
-    return results
+
+def get_hits_by_id(client: MTurkClient,
+                   hit_ids: List[str],
+                   hit_search_params: DataDict = {},
+                   max_workers: int = 16) \
+        -> List[DataDict]:
+    """ Fetches the HITs with the given HITIds from AMT for given client and parameters.
+
+    :param client: AMT client to use
+    :type client: botocore.client.BaseClient
+    :param hit_ids: HITIds of the HITs to fetch
+    :type hit_ids: list[str]
+    :param hit_search_params: Filter parameters to use when fetching HITs
+    :type hit_search_params: dict[str, any]
+    :param max_workers: Max number of HITs to fetch concurrently
+    :type max_workers: int
+    :return: List of fetched HITs
+    :rtype: list[dict[str, any]]
+    """
+    def get_one(hitid):
+        try:
+            return client.get_hit(HITId=hitid)['HIT']
+        except botocore.exceptions.ClientError as e:
+            print(f'Could not get HIT {hitid}: {e}')
+            return None
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        hits = list(executor.map(get_one, hit_ids))
+
+    hit_test = make_hit_test(hit_search_params)
+    return [hit for hit in hits if hit is not None and hit_test(hit)]
 
 
 def get_hit_assignments(client: MTurkClient,
@@ -287,25 +625,119 @@ def get_hit_assignments(client: MTurkClient,
     :rtype: list[dict[str, any]]
     """
     results = []
+    kwargs = {'HITId': hitid}
+
+    # Exact assignment statuses can be filtered by AMT already
+    statuses = assignment_search_params.get('AssignmentStatus', [])
+    if statuses and all(s in _ASSIGNMENT_STATUSES for s in statuses):
+        kwargs['AssignmentStatuses'] = list(statuses)
 
-    q = client.list_assignments_for_hit(HITId=hitid)
-    while q['NumResults'] > 0:
-        nt = q['NextToken']
-        assignments = q['Assignments']
-        for assign in assignments:
-            if test_hit(assign, assignment_search_params):
+    pages = client.get_paginator('list_assignments_for_hit').paginate(
+        PaginationConfig={'PageSize': 100},
+        **kwargs
+    )
+    assignment_test = make_hit_test(assignment_search_params)
+    for page in pages:
+        for assign in page['Assignments']:
+            if assignment_test(assign):
                 results.append(assign)
-        q = client.list_assignments_for_hit(HITId=hitid, NextToken=nt)
 
     return results
 
 
+def iter_all_assignments(client: MTurkClient,
+                         hit_search_params: DataDict = {},
+                         assignment_search_params: DataDict = {},
+                         print_info: bool = True,
+                         max_hits: int = -1,
+                         stop_after_first_hit: bool = False,
+                         max_workers: int = 16,
+                         hit_ids: Optional[List[str]] = None) \
+        -> Iterator[Tuple[DataDict, List[DataDict]]]:
+    """ Fetch all assignments for all HITs from AMT for given client and parameters
+    and generate them HIT by HIT as soon as they are fetched, in the order of the HITs.
+
+    :param client: AMT client to use
+    :type client: botocore.client.BaseClient
+    :param hit_search_params: Filter parameters to use when fetching HITs
+    :type hit_search_params: dict[str, any]
+    :param assignment_search_params: Filter parameters to use when fetching assignments
+    :type assignment_search_params: dict[str, any]
+    :param print_info: Whether to print information on the console. (verbosity)
+    :type print_info: bool
+    :param max_hits: Max number of HITs to fetch assignments for. < 0 for no limit.
+    :type max_hits: int
+    :param stop_after_first_hit: Whether to stop fetching HITs after the first one that
+    satisfies hit_search_params
+    :type stop_after_first_hit: bool
+    :param max_workers: Max number of HITs to fetch assignments for concurrently
+    :type max_workers: int
+    :param hit_ids: HITIds of the HITs to fetch. If given, only these HITs are fetched
+    and max_hits and stop_after_first_hit are not used.
+    :type hit_ids: list[str] | None
+    :return: Generator of tuples with a HIT and the list of its fetched assignments
+    :rtype: iterator[tuple[dict[str, any], list[dict[str, any]]]]
+    """
+    if hit_ids is not None:
+        hits = get_hits_by_id(
+            client, hit_ids,
+            hit_search_params=hit_search_params,
+            max_workers=max_workers
+        )
+    else:
+        # Listing HITs goes page by page, so the assignments of the listed
+        # HITs are already fetched while the next pages are listed
+        hits = iter_all_hits(
+            client,
+            hit_search_params=hit_search_params,
+            max_hits=max_hits,
+            stop_after_first=stop_after_first_hit
+        )
+
+    # Each HIT is a separate request, so the assignments are fetched concurrently
+    # with a shared client. The HITs are generated in order as soon as the
+    # assignments of the HIT and the HITs before it are fetched.
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = deque()
+        cnt = 0
+        size = 0
+        if print_info:
+            print('Gathering assignments... Ctrl+C to interrupt.')
+
+        try:
+            for hit in hits:
+                pending.append((hit, executor.submit(get_hit_assignments, client, hit['HITId'],
+                                                     assignment_search_params)))
+                size += 1
+
+                while pending and pending[0][1].done():
+                    done_hit, future = pending.popleft()
+                    yield done_hit, future.result()
+                    cnt += 1
+
+            while pending:
+                if print_info and cnt % 10 == 0:
+                    print(f'\rGathered assignments from {cnt}/{size} HITs', end='', flush=True)
+
+                done_hit, future = pending.popleft()
+                yield done_hit, future.result()
+                cnt += 1
+        except KeyboardInterrupt:
+            print(f'Interrupted by user! Got assignments for {cnt}/{size} HITs')
+        finally:
+            # Do not fetch the rest if interrupted or the generator is closed early
+            for _, future in pending:
+                future.cancel()
+
+
 def get_all_assignments(client: MTurkClient,
                         hit_search_params: DataDict = {},
                         assignment_search_params: DataDict = {},
                         print_info: bool = True,
                         max_hits: int = -1,
-                        stop_after_first_hit: bool = False) \
+                        stop_after_first_hit: bool = False,
+                        max_workers: int = 16,
+                        hit_ids: Optional[List[str]] = None) \
         -> Tuple[List[DataDict], Dict[str, DataDict]]:
     """ Fetch all assignments for all HITs from AMT for given client and parameters
 
@@ -322,35 +754,28 @@ def get_all_assignments(client: MTurkClient,
     :param stop_after_first_hit: Whether to stop fetching HITs after the first one that
     satisfies hit_search_params
     :type stop_after_first_hit: bool
+    :param max_workers: Max number of HITs to fetch assignments for concurrently
+    :type max_workers: int
+    :param hit_ids: HITIds of the HITs to fetch. If given, only these HITs are fetched
+    and max_hits and stop_after_first_hit are not used.
+    :type hit_ids: list[str] | None
     :return: Tuple with list of fetched assignments and a dict with the HIT info with
     HITIds as keys
     :rtype: tuple[list[dict[str, any]], dict[str, dict[str, any]]]
     """
     results = []
     hit_data = {}
-    hits = get_all_hits(
-        client,
-        hit_search_params=hit_search_params,
-        max_hits=max_hits,
-        stop_after_first=stop_after_first_hit
-    )
-    if print_info:
-        print('Gathering assignments... Ctrl+C to interrupt.')
-        cnt = 0
-        size = len(hits)
-    try:
-        for hit in hits:
-            if print_info and cnt % 10 == 0:
-                print(f'\rGathered assignments from {cnt}/{size} HITs', end='', flush=True)
-
-            hit_data[hit['HITId']] = hit
-            assignments = get_hit_assignments(client, hit['HITId'])
-            for assignment in assignments:
-                if test_hit(assignment, assignment_search_params):
-                    results.append(assignment)
-            cnt += 1
-    except KeyboardInterrupt:
-        print(f'Interrupted by user! Got assignments for {cnt}/{size} HITs')
+    for hit, assignments in iter_all_assignments(
+            client,
+            hit_search_params=hit_search_params,
+            assignment_search_params=assignment_search_params,
+            print_info=print_info,
+            max_hits=max_hits,
+            stop_after_first_hit=stop_after_first_hit,
+            max_workers=max_workers,
+            hit_ids=hit_ids):
+        hit_data[hit['HITId']] = hit
+        results.extend(assignments)
 
     return results, hit_data
 
@@ -368,9 +793,24 @@ def main():
     client = get_client(aws_keys, config)
     out_file = config['CURRENT']['output_data_file']
 
-    get_answer_data(
-        client, out_file,
-        hit_search_params=batch_params
+    # If create_hit.py has recorded all the HITs of the batch, only those are fetched
+    hit_ids = None
+    if config.get('FETCH_RECORDED_HITS', False):
+        hit_ids = read_hit_ids(
+            config.get('HIT_IDS_FILE', './data/hit_ids.json'),
+            get_endpoint_url(config),
+            get_req_annotation_for_batch(config)
+        )
+        if hit_ids is None:
+            print('The HITs of the batch have not all been recorded, going through all the HITs.')
+
+    # The rows are written as the assignments are fetched
+    stream_answer_data(
+        client,
+        out_file,
+        hit_search_params=batch_params,
+        hit_ids=hit_ids,
+        max_workers=config.get('MAX_IN_FLIGHT', 16)
     )
 
 
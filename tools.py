@@ -2,26 +2,74 @@
 # -*- coding: utf-8 -*-
 
 import csv
+import json
+import os
+from functools import lru_cache
+from itertools import chain, product
+from operator import itemgetter
 from pathlib import Path
-from typing import MutableMapping, NewType, Any, Dict, List, Union, Iterable
+from typing import TYPE_CHECKING, MutableMapping, NewType, Any, Dict, List, Union, Iterable, Iterator, Optional, Tuple
 
 import yaml
-import boto3
-import botocore
+
+try:
+    # libyaml bindings, much faster than the pure Python implementation
+    from yaml import CSafeLoader as _YamlLoader, CSafeDumper as _YamlDumper
+except ImportError:
+    from yaml import SafeLoader as _YamlLoader, SafeDumper as _YamlDumper
+
+try:
+    # Faster JSON parser, used for reading state files if installed
+    import orjson
+except ImportError:
+    orjson = None
+
+if TYPE_CHECKING:
+    # boto3 is slow to import, so it is imported when the first client is created
+    import boto3
+    import botocore.client
 
 __author__ = 'Samuel Lipping -- Tampere University'
 __docformat__ = 'reStructuredText'
 __all__ = ['get_client',
+           'get_endpoint_url',
            'read_yaml',
            'write_yaml',
+           'read_state',
+           'write_state',
            'get_req_annotation_for_batch',
+           'record_hit_ids',
+           'read_hit_ids',
            'replace_non_ascii',
-           'write_csv']
+           'NON_ASCII_REPLACEMENTS',
+           'write_csv',
+           'CsvWriter']
 
 # For easier type hinting
-MTurkClient = NewType('MTurkClient', botocore.client.BaseClient)
+MTurkClient = NewType('MTurkClient', 'botocore.client.BaseClient')
 CsvData = NewType('CsvData', Iterable[Dict[str, Any]])
 
+# Non-ASCII characters seen in annotations and their ASCII replacements
+NON_ASCII_REPLACEMENTS = {
+    u'\xe7': 'c',
+    u'\u2019': "'",
+    u'\xb7': '-',
+    u'\xed': 'i',
+    u'\u201c': "'",
+    u'\u201d': "'",
+    u'\xe0': 'a',
+    u'\xe2': "'"
+}
+
+# AMT endpoints by whether the sandbox is used
+_MTURK_ENDPOINTS = {
+    True: 'https://mturk-requester-sandbox.us-east-1.amazonaws.com',
+    False: 'https://mturk-requester.us-east-1.amazonaws.com'
+}
+
+# Directories already created by write_csv
+_MKDIR_CACHE = set()
+
 
 def get_client(keys: MutableMapping[str, str],
                config: MutableMapping[str, Any]) \
@@ -32,23 +80,84 @@ def get_client(keys: MutableMapping[str, str],
     :type keys: dict[str, str]
     :param config: Script settings
     :type config: dict
+    :return: The client object. The same client is returned for the same endpoint,
+    region and keys, so its connection pool stays warm between calls.
+    :rtype: botocore.client.BaseClient
+    """
+    return _create_client(
+        get_endpoint_url(config),
+        config['REGION_NAME'],
+        keys['access_key_id'],
+        keys['secret_access_key'],
+        max(64, config.get('MAX_IN_FLIGHT', 16))
+    )
+
+
+def get_endpoint_url(config: MutableMapping[str, Any]) \
+        -> str:
+    """ Get the AMT endpoint, sandbox or production, based on config
+
+    :param config: Script settings
+    :type config: dict
+    :return: The endpoint URL
+    :rtype: str
+    """
+    return _MTURK_ENDPOINTS[bool(config['USE_SANDBOX'])]
+
+
+@lru_cache(maxsize=None)
+def _get_session() \
+        -> 'boto3.session.Session':
+    """ Get the boto3 session shared by all the clients
+
+    :return: The session
+    :rtype: boto3.session.Session
+    """
+    import boto3.session
+
+    return boto3.session.Session()
+
+
+@lru_cache(maxsize=4)
+def _create_client(endpoint_url: str,
+                   region_name: str,
+                   access_key_id: str,
+                   secret_access_key: str,
+                   max_pool_connections: int) \
+        -> MTurkClient:
+    """ Create an AMT client object. Cached, see get_client.
+
+    :param endpoint_url: AMT endpoint
+    :type endpoint_url: str
+    :param region_name: AWS region
+    :type region_name: str
+    :param access_key_id: AWS access key ID
+    :type access_key_id: str
+    :param secret_access_key: AWS secret access key
+    :type secret_access_key: str
+    :param max_pool_connections: Max number of kept-alive connections
+    :type max_pool_connections: int
     :return: The created client object
     :rtype: botocore.client.BaseClient
     """
-    if config['USE_SANDBOX']:
-        endpoint_url = 'https://mturk-requester-sandbox.us-east-1.amazonaws.com'
-    else:
-        endpoint_url = 'https://mturk-requester.us-east-1.amazonaws.com'
+    import botocore.config
 
-    return boto3.client(
+    return _get_session().client(
         'mturk',
         endpoint_url=endpoint_url,
-        region_name=config['REGION_NAME'],
-        aws_access_key_id=keys['access_key_id'],
-        aws_secret_access_key=keys['secret_access_key'],
+        region_name=region_name,
+        aws_access_key_id=access_key_id,
+        aws_secret_access_key=secret_access_key,
         config=botocore.config.Config(
+            # Enough kept-alive connections for concurrent requests
+            max_pool_connections=max_pool_connections,
+            tcp_keepalive=True,
+            # Fail a hung request early, it is retried
+            connect_timeout=5,
+            read_timeout=30,
             retries=dict(
-                max_attempts=10
+                max_attempts=10,
+                mode='adaptive'
             )
         )
     )
@@ -63,7 +172,8 @@ def read_yaml(ifile: str) \
     :return: Yaml file contents
     :rtype: dict
     """
-    return yaml.safe_load(open(str(ifile)))
+    with open(str(ifile)) as f:
+        return yaml.load(f, Loader=_YamlLoader)
 
 
 def write_yaml(data: MutableMapping[str, Any],
@@ -76,12 +186,45 @@ def write_yaml(data: MutableMapping[str, Any],
     :param file: Output file path
     :type file: str
     """
-    yaml.dump(data, open(file, "w"))
+    with open(file, "w") as f:
+        yaml.dump(data, f, Dumper=_YamlDumper)
+
+
+def read_state(file: str) \
+        -> Any:
+    """ Read a JSON state file written by write_state
+
+    :param file: Input file path
+    :type file: str
+    :return: State file contents
+    :rtype: any
+    """
+    if orjson is not None:
+        with open(file, 'rb') as f:
+            return orjson.loads(f.read())
+
+    with open(file, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def write_state(data: Any,
+                file: str) \
+        -> None:
+    """ Write script state into a JSON file. Faster than yaml, used for files
+    that are not edited by hand.
+
+    :param data: Data to write
+    :type data: any
+    :param file: Output file path
+    :type file: str
+    """
+    with open(file, 'w', encoding='utf-8') as f:
+        json.dump(data, f, separators=(',', ':'))
 
 
 def get_req_annotation_for_batch(config: MutableMapping[str, Any],
                                  add_sw: bool = False) \
-        -> List[str]:
+        -> Tuple[str, ...]:
     """ Get the requester annotation based on config
 
     Format:
@@ -91,22 +234,105 @@ def get_req_annotation_for_batch(config: MutableMapping[str, Any],
     :type config: dict
     :param add_sw: Add '+' to the beginning (acts as a startswith)
     :type add_sw: bool
-    :return: Requester annotation
-    :rtype: str
+    :return: Requester annotations, one for each task and batch
+    :rtype: tuple[str, ...]
+    """
+    return _build_req_annotations(
+        str(config['CURRENT']['task']),
+        str(config['CURRENT']['batch']),
+        add_sw
+    )
+
+
+@lru_cache(maxsize=32)
+def _build_req_annotations(tasks: str,
+                           batches: str,
+                           add_sw: bool) \
+        -> Tuple[str, ...]:
+    """ Build the requester annotations. Cached, see get_req_annotation_for_batch.
+
+    :param tasks: Comma separated task names
+    :type tasks: str
+    :param batches: Comma separated batch numbers
+    :type batches: str
+    :param add_sw: Add '+' to the beginning (acts as a startswith)
+    :type add_sw: bool
+    :return: Requester annotations
+    :rtype: tuple[str, ...]
+    """
+    task_names = [task_name.strip() for task_name in tasks.split(',')]
+    batch_nums = [int(batch_num.strip()) for batch_num in batches.split(',')]
+    prefixes = ('+', '++') if add_sw else ('',)  # '++' for past mistakes
+
+    return tuple([
+        f'{prefix}{task_name} Batch {batch_num}'
+        for task_name, batch_num in product(task_names, batch_nums)
+        for prefix in prefixes
+    ])
+
+
+def record_hit_ids(file: str,
+                   endpoint_url: str,
+                   annotation: str,
+                   hit_ids: List[str],
+                   complete: bool) \
+        -> None:
+    """ Add the IDs of published HITs under their endpoint and requester annotation
+    in a JSON state file.
+
+    The HITIds of an annotation are marked complete only if every run that published
+    HITs for it was complete. A HIT may have been published without its ID being known,
+    e.g. if the run was interrupted, so one incomplete run leaves them incomplete for good.
+
+    :param file: HIT ID file path
+    :type file: str
+    :param endpoint_url: AMT endpoint the HITs were published to
+    :type endpoint_url: str
+    :param annotation: Requester annotation of the HITs
+    :type annotation: str
+    :param hit_ids: HITIds of the published HITs
+    :type hit_ids: list[str]
+    :param complete: Whether hit_ids are all the HITs published in the run
+    :type complete: bool
     """
-    options = []
-    for task_name in config['CURRENT']['task'].split(','):
-        task_name = task_name.strip()
-        for batch_num in str(config['CURRENT']['batch']).split(','):
-            batch_num = int(batch_num.strip())
+    path = Path(file)
+    recorded = read_state(path) if path.exists() else {}
+    batch = recorded.setdefault(endpoint_url, {}).setdefault(
+        annotation, {'hit_ids': [], 'complete': True}
+    )
+    batch['hit_ids'].extend(hit_ids)
+    batch['complete'] = batch['complete'] and complete
 
-            if not add_sw:
-                options.append(f'{task_name} Batch {batch_num}')
-            else:
-                options.append(f'+{task_name} Batch {batch_num}')
-                options.append(f'++{task_name} Batch {batch_num}')  # Past mistakes
+    path.parent.mkdir(exist_ok=True, parents=True)
+    write_state(recorded, str(path))
 
-    return options
+
+def read_hit_ids(file: str,
+                 endpoint_url: str,
+                 annotations: Iterable[str]) \
+        -> Optional[List[str]]:
+    """ Read the recorded IDs of the HITs with the given endpoint and requester annotations
+
+    :param file: HIT ID file path
+    :type file: str
+    :param endpoint_url: AMT endpoint the HITs were published to
+    :type endpoint_url: str
+    :param annotations: Requester annotations
+    :type annotations: iterable[str]
+    :return: HITIds or None if the recorded HITs of some annotation are missing or
+    not complete
+    :rtype: list[str] | None
+    """
+    path = Path(file)
+    if not path.exists():
+        return None
+
+    recorded = read_state(path).get(endpoint_url, {})
+    batches = [recorded.get(annotation) for annotation in annotations]
+    if any(batch is None or not batch['complete'] for batch in batches):
+        return None
+
+    return [hit_id for batch in batches for hit_id in batch['hit_ids']]
 
 
 def replace_non_ascii(string: str) \
@@ -119,40 +345,124 @@ def replace_non_ascii(string: str) \
     :return: "Sanitised" string
     :rtype: str
     """
-    return str(string.replace(u'\xe7', 'c')
-               .replace(u'\u2019', "'")
-               .replace(u'\xb7', '-')
-               .replace(u'\xed', 'i')
-               .replace(u'\u201c', "'")
-               .replace(u'\u201d', "'")
-               .replace(u'\xe0', 'a')
-               .replace(u'\xe2', "'"))
+    string = str(string)
+    # Most strings are ASCII already and have nothing to replace
+    if string.isascii():
+        return string
+
+    # str.replace finds a character with a fast search. For the few non-ASCII
+    # characters in a string, that beats str.translate, which looks up every
+    # character in the table, and a regex substitution with a callback.
+    for old, new in NON_ASCII_REPLACEMENTS.items():
+        string = string.replace(old, new)
+
+    return string
+
+
+def iter_csv(path: Union[Path, str], encoding=None) -> Iterator[Dict[str, str]]:
+    # encoding=None is the locale default
+    with open(os.fspath(path), 'r', encoding=encoding, newline='', buffering=1 << 16) as f:
+        yield from csv.DictReader(f)
 
 
 def read_csv(path: Union[Path, str], encoding=None) -> CsvData:
-    path = str(path)
-    result = []
-    if encoding is None:
-        with open(path, 'r') as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                result.append(row)
-    else:
-        with open(path, 'r', encoding=encoding) as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                result.append(row)
-
-    return result
+    return list(iter_csv(path, encoding=encoding))
 
 
 def write_csv(path: Union[Path, str], data: CsvData, mkdir=True):
-    path = Path(str(path))
-    if mkdir:
-        path.parent.mkdir(exist_ok=True, parents=True)
-    with path.open('w', newline='') as f:
-        writer = csv.DictWriter(f, data[0].keys())
-        writer.writeheader()
-        writer.writerows(data)
+    # Any iterable of rows, e.g. from iter_csv. The fields are taken from the first row.
+    rows = iter(data)
+    try:
+        first = next(rows)
+    except StopIteration:
+        return
+
+    with CsvWriter(path, list(first.keys()), mkdir=mkdir) as writer:
+        writer.write_rows(chain((first,), rows))
+
+
+class CsvWriter:
+    """ Write rows with the same fields into a csv file, one batch at a time.
+    The header is written when the writer is created.
+
+    Like csv.DictWriter, missing fields are written as empty cells and a row with
+    fields that are not in fieldnames raises a ValueError.
+
+    :param path: Output file path
+    :type path: pathlib.Path | str
+    :param fieldnames: Column names, which are the keys of the rows
+    :type fieldnames: list[str]
+    :param mkdir: Create the parent directory of the file if needed
+    :type mkdir: bool
+    """
+
+    def __init__(self,
+                 path: Union[Path, str],
+                 fieldnames: List[str],
+                 mkdir: bool = True):
+        self._fieldnames = list(fieldnames)
+        self._fieldset = frozenset(self._fieldnames)
+
+        # One C call per complete row instead of DictWriter's per-field lookups and key check
+        if not self._fieldnames:
+            self._get_row = lambda row: ()
+        elif len(self._fieldnames) == 1:
+            get_field = itemgetter(self._fieldnames[0])
+            self._get_row = lambda row: (get_field(row),)
+        else:
+            self._get_row = itemgetter(*self._fieldnames)
+
+        path = path if isinstance(path, Path) else Path(path)
+        if mkdir and path.parent not in _MKDIR_CACHE:
+            path.parent.mkdir(exist_ok=True, parents=True)
+            _MKDIR_CACHE.add(path.parent)
+
+        self._file = path.open('w', newline='', buffering=1 << 20)
+        self._writer = csv.writer(self._file)
+        self._writer.writerow(self._fieldnames)
+
+    def write_rows(self,
+                   rows: CsvData) \
+            -> None:
+        """ Write rows into the file
+
+        :param rows: Rows to write
+        :type rows: iterable[dict[str, any]]
+        """
+        self._writer.writerows(map(self._row_values, rows))
+
+    def _row_values(self,
+                    row: Dict[str, Any]) \
+            -> Tuple[Any, ...]:
+        """ Get the values of a row in the order of the fieldnames
+
+        :param row: The row
+        :type row: dict[str, any]
+        :return: The values
+        :rtype: tuple[any, ...]
+        """
+        # A row with as many keys as there are fields and none missing has exactly the fields
+        if len(row) == len(self._fieldnames):
+            try:
+                return self._get_row(row)
+            except KeyError:
+                pass
+
+        extra = [key for key in row if key not in self._fieldset]
+        if extra:
+            raise ValueError(f'dict contains fields not in fieldnames: {", ".join(map(repr, extra))}')
+
+        return tuple(row.get(key, '') for key in self._fieldnames)
+
+    def close(self) \
+            -> None:
+        """ Close the file """
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
 
 # EOF